@@ -2,43 +2,138 @@
 import streamlit as st
 import pandas as pd
 import numpy as np
-from data_loader import get_master_dataframe, get_downloads_dataframe, get_mtime, DATA_FILE, DOWNLOADS_FILE
+from data_loader import get_master_dataframe, get_downloads_dataframe, get_mtime, format_tags, DATA_FILE, DOWNLOADS_FILE
 import datetime
+from collections import defaultdict
+from urllib.parse import urlencode
 
 # --- CONFIGURATION ---
 BASE_URL = "https://tcia-streamlit.duckdns.org/dataset-browser/"
+FILTERS = [
+    ("Data Type", "data_types"), ("Data Category", "data_category"),
+    ("Cancer Type", "cancer_types"), ("Cancer Location", "cancer_locations"),
+    ("External Resources", "supporting_data"), ("Program", "program"),
+    ("License", "licenses")
+]
+SORT_OPTIONS = [
+    ("Release Date", "date_updated"), ("Alphabetical (Short Title)", "_sort_title"),
+    ("Number of Subjects", "number_of_subjects")
+]
 
 # --- Helper Functions ---
-def get_unique_values_from_column(df, column_name):
-    if column_name not in df.columns: return []
-    if df[column_name].apply(lambda x: isinstance(x, list)).any():
-        valid_lists = df[column_name][df[column_name].apply(lambda x: isinstance(x, list))]
-        unique_values = set(v for v_list in valid_lists for v in v_list if v)
-    else:
-        unique_values = set(df[column_name].unique())
-    return sorted(list(unique_values - {''}))
-
-def format_tags(tags_list, use_code_style=True):
-    if isinstance(tags_list, np.ndarray):
-        tags_list = tags_list.tolist()
-    if not isinstance(tags_list, list): return "N/A"
-    if not tags_list: return "N/A"
-    if use_code_style:
-        return " | ".join(f"`{tag}`" for tag in tags_list)
-    return " | ".join(str(tag) for tag in tags_list)
-
 def format_tags_html(tags_list):
-    if isinstance(tags_list, np.ndarray):
-        tags_list = tags_list.tolist()
-    if not isinstance(tags_list, list): return "N/A"
-    if not tags_list: return "N/A"
-    return " | ".join(str(tag) for tag in tags_list)
+    # Expects a list column canonicalized by normalize_list_column
+    return " | ".join(str(tag) for tag in tags_list) if tags_list else "N/A"
+
+def parse_range_param(value, parse, low, high):
+    """
+    Parses a "start,end" query parameter and clamps it to [low, high]; malformed values fall back to the full range.
+    """
+    try:
+        start, end = (parse(v) for v in value.split(','))
+    except (ValueError, TypeError):
+        return (low, high)
+    start, end = min(max(start, low), high), min(max(end, low), high)
+    return (start, end) if start <= end else (low, high)
+
+def normalize_list_column(column):
+    """
+    Returns the column's values as lists: numpy arrays (as read from parquet) are converted, anything else becomes [].
+    """
+    vals = column.to_numpy(dtype=object, copy=True)
+    is_array = np.fromiter((isinstance(v, np.ndarray) for v in vals), dtype=bool, count=len(vals))
+    is_list = np.fromiter((isinstance(v, list) for v in vals), dtype=bool, count=len(vals))
+    for i in np.flatnonzero(is_array):
+        vals[i] = vals[i].tolist()
+    for i in np.flatnonzero(~(is_array | is_list)):
+        vals[i] = []
+    return vals
+
+@st.cache_data(show_spinner=False)
+def prepare_master_dataframe(mtime):
+    """
+    Normalizes the master DataFrame once per data file version so reruns reuse the result.
+    """
+    df = get_master_dataframe(mtime)
+    list_cols = ['cancer_types', 'cancer_locations', 'supporting_data', 'data_types', 'program', 'related_datasets', 'licenses', 'data_category']
+    for col in list_cols:
+        if col in df.columns:
+            df[col] = normalize_list_column(df[col])
+    df['date_updated'] = pd.to_datetime(df['date_updated'], errors='coerce')
+    df['number_of_subjects'] = pd.to_numeric(df['number_of_subjects'], errors='coerce').fillna(0).astype(int)
+    df = df.sort_values('date_updated', ascending=False, na_position='last').reset_index(drop=True)
+
+    # Lowercased text of every searchable field, so the free-text search is a plain substring scan
+    search_cols = ['title', 'short_title', 'summary', 'citation', 'program', 'data_types', 'cancer_types', 'cancer_locations']
+    search_text = pd.Series('', index=df.index)
+    for col in search_cols:
+        if col in df.columns:
+            values = df[col].map(' '.join) if col in list_cols else df[col].fillna('').astype(str)
+            search_text = search_text + ' ' + values
+    df['_search_blob'] = search_text.str.lower().astype("string[pyarrow]")
+
+    # Inverted index per sidebar filter: value -> boolean row mask
+    filter_index = {}
+    for _, column in FILTERS:
+        if column in df.columns:
+            index = defaultdict(lambda: np.zeros(len(df), dtype=bool))
+            for i, values in enumerate(df[column]):
+                for v in values:
+                    index[v][i] = True
+            filter_index[column] = dict(index)
+    filter_options = {column: sorted(v for v in index if v) for column, index in filter_index.items()}
+
+    # Row order for every (sort option, ascending) pair, so results never need sorting on rerun
+    df['_sort_title'] = df['short_title'].fillna('').replace('', np.nan).fillna(df['title']).str.lower()
+    sort_orders = {}
+    for label, column in SORT_OPTIONS:
+        for ascending in (True, False):
+            sorted_rows = df[column].sort_values(ascending=ascending, na_position='last', kind='stable')
+            sort_orders[(label, ascending)] = sorted_rows.index.to_numpy()
+
+    # Sidebar slider and date picker bounds
+    valid_dates = df['date_updated'].dropna()
+    bounds = (int(df['number_of_subjects'].min()), int(df['number_of_subjects'].max()), valid_dates.min().date(), valid_dates.max().date())
+    # df is sorted newest first with NaT last, so the reversed valid dates are ascending and searchsorted-ready
+    dates_asc = valid_dates.to_numpy()[::-1].copy()
+    return df, filter_index, filter_options, sort_orders, bounds, dates_asc
+
+@st.cache_data(show_spinner=False)
+def prepare_download_tables(mtime):
+    """
+    Builds the downloadable files table for each dataset once per downloads file version, keyed by parent_id.
+    """
+    downloads_df = get_downloads_dataframe(mtime)
+    for col in ['download_types', 'data_types']:
+        if col in downloads_df.columns:
+            downloads_df[col] = normalize_list_column(downloads_df[col])
+    download_tables = {}
+    for parent_id, relevant_downloads in downloads_df.groupby('parent_id', sort=False):
+        html = "<table style='width:100%'>"
+        html += "<tr><th>Title</th><th>Size</th><th>Category</th><th>Data Type</th><th>License</th><th>Links</th></tr>"
+        for d_row in relevant_downloads.to_dict('records'):
+            links = []
+            if d_row['download_url']:
+                links.append(f'<a href="{d_row["download_url"]}" target="_blank">Download</a>')
+            if d_row['search_url']:
+                links.append(f'<a href="{d_row["search_url"]}" target="_blank">Search</a>')
+
+            links_html = " | ".join(links)
+            category = format_tags_html(d_row.get('download_types', []))
+            data_types = format_tags_html(d_row.get('data_types', []))
+            license_label = d_row['license_label']
+            size = f"{d_row['download_size']} {d_row['download_size_unit']}"
+
+            html += f"<tr><td>{d_row['download_title']}</td><td>{size}</td><td>{category}</td><td>{data_types}</td><td>{license_label}</td><td>{links_html}</td></tr>"
+        html += "</table>"
+        download_tables[parent_id] = html
+    return download_tables
 
 # --- Page Configuration ---
 st.set_page_config(page_title="TCIA Dataset Explorer", page_icon="🔬", layout="wide")
 
 # --- Load and Prepare Data ---
-df = get_master_dataframe(get_mtime(DATA_FILE))
+df, filter_index, filter_options, sort_orders, bounds, dates_asc = prepare_master_dataframe(get_mtime(DATA_FILE))
 downloads_df = get_downloads_dataframe(get_mtime(DOWNLOADS_FILE))
 
 # --- Verify columns exist ---
@@ -55,74 +150,64 @@ if missing_df or missing_downloads:
     st.warning("This may happen if the app was updated but the data was not re-synced. Please run `python sync_data.py` to refresh your data.")
     st.stop()
 
-list_cols = ['cancer_types', 'cancer_locations', 'supporting_data', 'data_types', 'program', 'related_datasets', 'licenses', 'data_category']
-for col in list_cols:
-    if col in df.columns:
-        df[col] = df[col].apply(lambda x: list(x) if isinstance(x, np.ndarray) else x if isinstance(x, list) else [])
-df['date_updated'] = pd.to_datetime(df['date_updated'], errors='coerce')
+download_tables = prepare_download_tables(get_mtime(DOWNLOADS_FILE))
 
 # --- Process URL Query Parameters to set defaults ---
+# Filter selections are comma-separated lists; everything else ('q', 'subject_range', 'date_range') stays a string
+LIST_PARAMS = {column for _, column in FILTERS}
 query_params = st.query_params.to_dict()
-defaults = {key: value[0].split(',') if isinstance(value, list) else value.split(',') for key, value in query_params.items()}
+defaults = {key: value.split(',') if key in LIST_PARAMS else value for key, value in query_params.items()}
 
 # --- Sidebar ---
 st.sidebar.image("https://www.cancerimagingarchive.net/wp-content/uploads/2021/06/TCIA-Logo-01.png")
 st.sidebar.header("Filter Datasets")
 
-search_query = st.sidebar.text_input("Search all fields...", help="Performs a case-insensitive search.", value=','.join(defaults.get('q', [''])))
-FILTERS = [
-    ("Data Type", "data_types"), ("Data Category", "data_category"),
-    ("Cancer Type", "cancer_types"), ("Cancer Location", "cancer_locations"),
-    ("External Resources", "supporting_data"), ("Program", "program"),
-    ("License", "licenses")
-]
+search_query = st.sidebar.text_input("Search all fields...", help="Performs a case-insensitive search.", value=defaults.get('q', ''))
 selected_filters = {}
 for label, column in FILTERS:
-    options = get_unique_values_from_column(df, column)
+    options = filter_options.get(column, [])
     if options:
         valid_defaults = [v for v in defaults.get(column, []) if v in options]
         selected_filters[column] = st.sidebar.multiselect(label, options, default=valid_defaults)
 
-df['number_of_subjects'] = pd.to_numeric(df['number_of_subjects'], errors='coerce').fillna(0).astype(int)
-min_subjects, max_subjects = int(df['number_of_subjects'].min()), int(df['number_of_subjects'].max())
-default_subjects = defaults.get('subject_range', [f"{min_subjects},{max_subjects}"])[0].split(',')
-default_subject_range = (int(default_subjects[0]), int(default_subjects[1])) if len(default_subjects) == 2 else (min_subjects, max_subjects)
+min_subjects, max_subjects, min_date, max_date = bounds
+default_subject_range = parse_range_param(defaults.get('subject_range', ''), int, min_subjects, max_subjects)
 subject_range = st.sidebar.slider("Number of Subjects", min_subjects, max_subjects, default_subject_range)
 
-valid_dates = df['date_updated'].dropna()
-min_date, max_date = valid_dates.min().date(), valid_dates.max().date()
-default_dates = defaults.get('date_range', [f"{min_date},{max_date}"])[0].split(',')
-default_date_range = (datetime.datetime.strptime(default_dates[0], '%Y-%m-%d').date(), datetime.datetime.strptime(default_dates[1], '%Y-%m-%d').date()) if len(default_dates) == 2 else (min_date, max_date)
+default_date_range = parse_range_param(defaults.get('date_range', ''), lambda v: datetime.datetime.strptime(v, '%Y-%m-%d').date(), min_date, max_date)
 date_range = st.sidebar.date_input("Date Updated", default_date_range, min_date, max_date)
 
 # --- ROBUST FILTERING LOGIC ---
-final_mask = pd.Series(True, index=df.index)
-if search_query:
-    search_cols = ['title', 'short_title', 'summary', 'citation', 'program', 'data_types', 'cancer_types', 'cancer_locations']
-    existing_search_cols = [col for col in search_cols if col in df.columns]
-    search_text = df[existing_search_cols].astype(str).agg(' '.join, axis=1)
-    final_mask &= search_text.str.contains(search_query, case=False, na=False)
-
+final_mask = np.ones(len(df), dtype=bool)
 for column, selected_values in selected_filters.items():
     if selected_values:
-        if df[column].apply(lambda x: isinstance(x, list)).any():
-            mask = df[column].apply(lambda lst: any(v in selected_values for v in lst))
-        else:
-            mask = df[column].isin(selected_values)
+        mask = np.zeros(len(df), dtype=bool)
+        for v in selected_values:
+            mask |= filter_index[column][v]
         final_mask &= mask
 
-final_mask &= df['number_of_subjects'].between(subject_range[0], subject_range[1])
+final_mask &= df['number_of_subjects'].between(subject_range[0], subject_range[1]).to_numpy()
 if len(date_range) == 2:
     start_date = pd.to_datetime(date_range[0])
     end_date = pd.to_datetime(date_range[1])
-    final_mask &= df['date_updated'].between(start_date, end_date, inclusive='both')
+    # Rows [lo, hi) of dates_asc fall in the range; they map back onto df's newest-first rows in reverse
+    lo = np.searchsorted(dates_asc, start_date.to_datetime64(), side='left')
+    hi = np.searchsorted(dates_asc, end_date.to_datetime64(), side='right')
+    date_mask = np.zeros(len(df), dtype=bool)
+    date_mask[len(dates_asc) - hi:len(dates_asc) - lo] = True
+    final_mask &= date_mask
+
+# The substring scan is the expensive filter, so only run it on rows that survived the others
+if search_query:
+    candidates = np.flatnonzero(final_mask)
+    final_mask[candidates] = df['_search_blob'].iloc[candidates].str.contains(search_query.lower(), regex=False, na=False).to_numpy(dtype=bool)
 
-filtered_df = df[final_mask].copy()
+total_results = int(np.count_nonzero(final_mask))
 
 # --- Main Panel ---
 st.title("🔬 TCIA Dataset Explorer")
 st.markdown("An interactive tool to filter and find datasets from The Cancer Imaging Archive.")
-st.write(f"**Found {len(filtered_df)} matching datasets.**")
+st.write(f"**Found {total_results} matching datasets.**")
 
 # --- Share Query ---
 share_params = {}
@@ -135,7 +220,7 @@ if date_range != (min_date, max_date):
     share_params['date_range'] = f"{date_range[0].strftime('%Y-%m-%d')},{date_range[1].strftime('%Y-%m-%d')}"
 
 if share_params:
-    query_string = "&".join([f"{key}={','.join(value) if isinstance(value, list) else value}" for key, value in share_params.items()])
+    query_string = urlencode(share_params, safe=',')
     share_url = f"{BASE_URL}?{query_string}"
     st.markdown("**Share this query:**")
     st.code(share_url)
@@ -144,23 +229,16 @@ st.markdown("---")
 
 # --- Sorting and Pagination Controls ---
 sort_col, order_col, size_col = st.columns([3, 2, 2])
-sort_by = sort_col.selectbox("Sort by", options=["Release Date", "Alphabetical (Short Title)", "Number of Subjects"], index=0)
+sort_by = sort_col.selectbox("Sort by", options=[label for label, _ in SORT_OPTIONS], index=0)
 sort_order = order_col.radio("Order", options=["Descending", "Ascending"], horizontal=True)
 PAGE_SIZE = size_col.selectbox("Results per page", options=[10, 25, 50, 100], index=1)
 
-# Apply Sorting
-ascending = (sort_order == "Ascending")
-if sort_by == "Release Date":
-    filtered_df = filtered_df.sort_values(by="date_updated", ascending=ascending)
-elif sort_by == "Alphabetical (Short Title)":
-    filtered_df['sort_title_tmp'] = filtered_df['short_title'].fillna('').replace('', np.nan).fillna(filtered_df['title']).str.lower()
-    filtered_df = filtered_df.sort_values(by="sort_title_tmp", ascending=ascending)
-elif sort_by == "Number of Subjects":
-    filtered_df = filtered_df.sort_values(by="number_of_subjects", ascending=ascending)
+# Apply Sorting: walk the precomputed order and keep the rows that passed the filters
+order = sort_orders[(sort_by, sort_order == "Ascending")]
+hits = order[final_mask[order]]
 
 # Pagination logic
 if 'current_page' not in st.session_state: st.session_state.current_page = 1
-total_results = len(filtered_df)
 total_pages = max(1, (total_results // PAGE_SIZE) + (1 if total_results % PAGE_SIZE > 0 else 0))
 st.session_state.current_page = min(st.session_state.current_page, total_pages)
 
@@ -180,14 +258,16 @@ if total_pages > 1:
 
 start_index = (st.session_state.current_page - 1) * PAGE_SIZE
 end_index = start_index + PAGE_SIZE
-paginated_df = filtered_df.iloc[start_index:end_index]
+paginated_df = df.iloc[hits[start_index:end_index]]
 
 if paginated_df.empty:
     st.warning("No datasets match the current filter criteria. Please broaden your search.")
 else:
-    for _, row in paginated_df.iterrows():
+    for i, row in enumerate(paginated_df.to_dict('records')):
+        # The separator between rows is emitted together with the next row's title
         display_title = f"{row.get('short_title', '')} | {row['title']}" if row.get('short_title') else row['title']
-        st.markdown(f"### [{display_title}]({row['link']})")
+        separator = "---\n\n" if i > 0 else ""
+        st.markdown(f"{separator}### [{display_title}]({row['link']})")
 
         # Compact layout
         c1, c2, c3, c4, c5 = st.columns([3, 2, 1, 1, 1.5])
@@ -203,57 +283,37 @@ else:
         c5.markdown(f"**Updated:** `{row['date_updated'].strftime('%Y-%m-%d') if pd.notna(row['date_updated']) else 'N/A'}`")
 
         c6, c7 = st.columns(2)
-        c6.markdown(f"**Data Type(s):** {format_tags(row.get('data_types'))}")
-        c7.markdown(f"**External Resources:** {format_tags(row.get('supporting_data'))}")
-
-        c8, c9 = st.columns(2)
-        c8.markdown(f"**Data Category:** {format_tags(row.get('data_category'))}")
-        c9.markdown(f"**License(s):** {format_tags(row.get('licenses'))}")
-
-        st.markdown(f"**Cancer Type(s):** {format_tags(row.get('cancer_types'))}")
-        st.markdown(f"**Cancer Location(s):** {format_tags(row.get('cancer_locations'))}")
+        c6.markdown(f"**Data Type(s):** {format_tags(row.get('data_types'))}\n\n**Data Category:** {format_tags(row.get('data_category'))}")
+        c7.markdown(f"**External Resources:** {format_tags(row.get('supporting_data'))}\n\n**License(s):** {format_tags(row.get('licenses'))}")
 
         # Related Datasets - Rendering them directly to ensure links work
         related = row.get('related_datasets', [])
         if isinstance(related, (list, np.ndarray)) and len(related) > 0:
-            st.markdown(f"**Related Datasets:** {' | '.join(related)}")
+            related_md = f"**Related Datasets:** {' | '.join(related)}"
         else:
-            st.markdown("**Related Datasets:** N/A")
+            related_md = "**Related Datasets:** N/A"
+        st.markdown("\n\n".join([
+            f"**Cancer Type(s):** {format_tags(row.get('cancer_types'))}",
+            f"**Cancer Location(s):** {format_tags(row.get('cancer_locations'))}",
+            related_md,
+        ]))
 
         if row.get('citation') or row.get('summary'):
             with st.expander("View Citation and Abstract"):
+                sections = []
                 if row.get('citation'):
-                    st.markdown(f"**Citation:** {row['citation']}")
-                    if row.get('summary'): st.markdown("---")
+                    sections.append(f"**Citation:** {row['citation']}")
                 if row.get('summary'):
-                    st.markdown(f"**Abstract:** {row['summary']}")
+                    sections.append(f"**Abstract:** {row['summary']}")
+                st.markdown("\n\n---\n\n".join(sections))
 
         # Link to downloads via parent_id
-        dataset_id = row['id']
-        relevant_downloads = downloads_df[downloads_df['parent_id'] == dataset_id]
-
-        if not relevant_downloads.empty:
+        downloads_table = download_tables.get(row['id'])
+        if downloads_table:
             with st.expander("View Downloadable Files"):
-                    html = "<table style='width:100%'>"
-                    html += "<tr><th>Title</th><th>Size</th><th>Category</th><th>Data Type</th><th>License</th><th>Links</th></tr>"
-                    for _, d_row in relevant_downloads.iterrows():
-                        links = []
-                        if d_row['download_url']:
-                            links.append(f'<a href="{d_row["download_url"]}" target="_blank">Download</a>')
-                        if d_row['search_url']:
-                            links.append(f'<a href="{d_row["search_url"]}" target="_blank">Search</a>')
-
-                        links_html = " | ".join(links)
-                        category = format_tags_html(d_row.get('download_types', []))
-                        data_types = format_tags_html(d_row.get('data_types', []))
-                        license_label = d_row['license_label']
-                        size = f"{d_row['download_size']} {d_row['download_size_unit']}"
-
-                        html += f"<tr><td>{d_row['download_title']}</td><td>{size}</td><td>{category}</td><td>{data_types}</td><td>{license_label}</td><td>{links_html}</td></tr>"
-                    html += "</table>"
-                    st.markdown(html, unsafe_allow_html=True)
-
-        st.markdown("---")
+                st.markdown(downloads_table, unsafe_allow_html=True)
+
+    st.markdown("---")
 
     if total_pages > 1:
         render_pagination("bottom")
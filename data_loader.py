@@ -1,6 +1,8 @@
 # data_loader.py (Updated)
 import pandas as pd
+import numpy as np
 import streamlit as st
+from functools import lru_cache
 
 # The filename where the synced data is stored
 DATA_FILE = "tcia_master_data.parquet"
@@ -13,6 +15,21 @@ def get_mtime(filepath):
         return os.path.getmtime(filepath)
     return 0
 
+# Tag formatting lives here rather than in app.py because Streamlit re-executes
+# app.py on every rerun, which would rebuild the lru_cache empty each time.
+@lru_cache(maxsize=4096)
+def _format_tags_tuple(tags, use_code_style):
+    if not tags: return "N/A"
+    if use_code_style:
+        return " | ".join(f"`{tag}`" for tag in tags)
+    return " | ".join(str(tag) for tag in tags)
+
+def format_tags(tags_list, use_code_style=True):
+    if isinstance(tags_list, np.ndarray):
+        tags_list = tags_list.tolist()
+    if not isinstance(tags_list, list): return "N/A"
+    return _format_tags_tuple(tuple(tags_list), use_code_style)
+
 @st.cache_data(show_spinner="Loading TCIA data...")
 def get_master_dataframe(mtime):
     """